@@ -2,11 +2,23 @@ import gradio as gr
 import modules.scripts as scripts
 from modules import shared, processing
 from modules.ui_components import ToolButton
-from PIL import Image
-import requests
 import json
+import os
+import random
+import ssl
 import base64
+import collections
+import concurrent.futures
+import copy
+import functools
+import hashlib
 import io
+import struct
+import threading
+import time
+import zipfile
+import zlib
+import asyncio
 import traceback # For detailed error logging
 
 # --- Configuration ---
@@ -18,34 +30,192 @@ NAI_SAMPLERS = [
     "k_dpmpp_sde", "ddim_v3" # Add/remove based on NAI API docs/observation
 ]
 
-# --- API Call Helper ---
-def call_novelai_api(api_key, prompt, neg_prompt, width, height, steps, scale, sampler, seed, director_json_str):
+# --- Lazy Imports / Shared Session ---
+# The heavyweight third-party imports are deferred to the first enabled
+# generation: requests alone drags in urllib3, charset-normalizer and
+# certifi, PIL and the optional transports add more, and none of it is
+# needed at WebUI boot when the user never enables the NAI override.
+# _lazy_init() resolves them into the module globals the helpers below
+# reference at call time; until then the stdlib fallbacks are bound.
+requests = None        # set by _lazy_init
+Image = None           # set by _lazy_init
+aiohttp = None         # stays None when not installed
+httpx = None           # stays None when not installed
+_HTTPX_HTTP2 = False
+_b64decode = base64.b64decode
+_loads = json.loads
+_ACCEPT_ENCODING = "gzip, deflate"
+_SESSION = None
+_INIT_LOCK = threading.Lock()
+
+
+def _dumps(obj, pretty=False):
+    return json.dumps(obj, indent=2 if pretty else None).encode()
+
+
+def _lazy_init():
     """
-    Handles the construction of the request and the call to the NovelAI API.
-    Returns: Tuple (list[PIL.Image] | None, str) -> (images, info_text/error_message)
+    Imports the network/image stack and builds the shared session, once, on
+    the first enabled generation. Safe to call from any thread.
     """
-    if not api_key:
-        return None, "Error: NovelAI API Key is missing."
-
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "accept": "application/json" # Often required by APIs
-    }
+    global requests, Image, aiohttp, httpx, _HTTPX_HTTP2
+    global _b64decode, _loads, _dumps, _ACCEPT_ENCODING, _SESSION
+    with _INIT_LOCK:
+        if _SESSION is not None:
+            return
+
+        import requests as _requests
+        import requests.adapters
+        from urllib3.util.retry import Retry
+        from PIL import Image as _Image
+        requests = _requests
+        Image = _Image
+
+        # aiohttp lets us fire a whole batch of generations concurrently over
+        # one session. Optional: without it we fall back to blocking requests.
+        try:
+            import aiohttp as _aiohttp
+            aiohttp = _aiohttp
+        except ImportError:
+            pass
+
+        # httpx is the preferred async transport: with the h2 extra installed
+        # it multiplexes all concurrent seed requests over one HTTP/2 TLS
+        # session (one handshake instead of N, HPACK-compressed headers).
+        try:
+            import httpx as _httpx
+            httpx = _httpx
+            try:
+                import h2
+                _HTTPX_HTTP2 = True
+            except ImportError:
+                pass
+        except ImportError:
+            pass
+
+        # SIMD-accelerated base64 (AVX2/SSSE3); ~2-4x faster than the stdlib
+        # scalar decoder on the MB-sized payloads NAI streams back. Optional.
+        try:
+            import pybase64
+            _b64decode = pybase64.b64decode
+        except ImportError:
+            pass
 
-    # --- Parse Director Tools JSON ---
-    director_params = {}
-    if director_json_str and director_json_str.strip():
+        # orjson serializes ~3-5x faster than stdlib json and returns bytes
+        # directly, skipping the separate UTF-8 encode. Optional.
         try:
-            director_params = json.loads(director_json_str)
-            if not isinstance(director_params, dict):
-                 raise ValueError("Director Tools JSON must decode to a dictionary (object).")
-        except json.JSONDecodeError as e:
-            return None, f"Error: Invalid JSON in Director Tools field: {e}"
-        except ValueError as e:
-             return None, f"Error: {e}"
+            import orjson
+            _loads = orjson.loads
 
-    # --- Construct API Payload ---
+            def _dumps(obj, pretty=False):
+                return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+        except ImportError:
+            pass
+
+        # Advertise brotli only when it is importable: urllib3, aiohttp and
+        # httpx all decompress br transparently once the package is present.
+        # SSE/base64 and JSON bodies compress ~35-45%.
+        try:
+            import brotli
+            _ACCEPT_ENCODING = "br, gzip, deflate"
+        except ImportError:
+            pass
+
+        # A shared session keeps the TCP+TLS connection to api.novelai.net
+        # alive between generations, saving a full handshake (~100-400ms) on
+        # every call after the first. The Authorization header is built
+        # per-call so a changed API key takes effect without a rebuild.
+        session = _requests.Session()
+        # POST is not in urllib3's default allowed_methods, so it must be
+        # listed explicitly for the status_forcelist to apply. Transient
+        # 429/5xx responses then retry with backoff (honoring Retry-After)
+        # instead of wasting the user's Anlas-spending prompt; 400/401/403
+        # still fail fast.
+        session.mount("https://", requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.5,
+                              status_forcelist=[429, 502, 503, 504],
+                              allowed_methods=['POST'],
+                              respect_retry_after_header=True)
+        ))
+        session.headers.update({
+            # Ask for the binary zip output so NAI can skip the base64 encode
+            # and we skip the decode; the response branches still handle
+            # whatever comes back.
+            "accept": "application/zip",
+            "Accept-Encoding": _ACCEPT_ENCODING,
+            "Content-Type": "application/json"
+        })
+        _SESSION = session
+
+# Worker pool for the (up to 180s) API calls, so the WebUI thread keeps
+# servicing progress updates and the Interrupt button while we wait.
+_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='nai')
+
+# --- Result Cache ---
+# Bounded LRU of raw API responses keyed by a fingerprint of the serialized
+# request body (which includes the seed). NAI generation is deterministic for
+# a fixed payload+seed, so re-submitting an identical request - common while
+# a user toggles unrelated UI options - can be served locally, costing
+# neither Anlas nor a network round-trip.
+_RESULT_CACHE = collections.OrderedDict()
+_RESULT_CACHE_MAX = 16
+_RESULT_CACHE_LOCK = threading.Lock()
+
+
+def _cache_key(body):
+    # BLAKE2b is ~3x faster than SHA-256 and plenty as a non-cryptographic
+    # fingerprint.
+    return hashlib.blake2b(body, digest_size=16).digest()
+
+
+def _cache_get(key):
+    with _RESULT_CACHE_LOCK:
+        result = _RESULT_CACHE.get(key)
+        if result is not None:
+            _RESULT_CACHE.move_to_end(key)
+        return result
+
+
+def _cache_put(key, result):
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE[key] = result
+        _RESULT_CACHE.move_to_end(key)
+        while len(_RESULT_CACHE) > _RESULT_CACHE_MAX:
+            _RESULT_CACHE.popitem(last=False)
+
+
+def clear_result_cache():
+    """Handler for the 'Clear NAI result cache' button in the accordion."""
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE.clear()
+    print("NovelAI script: result cache cleared.")
+
+# --- Payload Helpers ---
+@functools.lru_cache(maxsize=8)
+def _parse_director_json(director_json_str):
+    """
+    Parses the Director Tools JSON textbox contents. Memoized on the raw
+    string, so sequential generations with an unchanged field skip the
+    re-parse; editing the field changes the key and invalidates naturally.
+    Callers must treat the returned dict as read-only.
+    Returns: Tuple (dict | None, str | None) -> (director_params, error_message)
+    """
+    if not director_json_str or not director_json_str.strip():
+        return {}, None
+    try:
+        director_params = _loads(director_json_str)
+        if not isinstance(director_params, dict):
+            raise ValueError("Director Tools JSON must decode to a dictionary (object).")
+        return director_params, None
+    except json.JSONDecodeError as e:
+        return None, f"Error: Invalid JSON in Director Tools field: {e}"
+    except ValueError as e:
+        return None, f"Error: {e}"
+
+
+def _build_payload(prompt, neg_prompt, width, height, steps, scale, sampler, seed, director_params):
+    """Builds the request payload for a single generation."""
     # !!! CRITICAL: This payload structure is SPECULATIVE based on common patterns
     # !!!          and needs verification against the actual NovelAI API.
     # !!!          Director Tools parameters ('director_settings' below) are a GUESS.
@@ -77,21 +247,537 @@ def call_novelai_api(api_key, prompt, neg_prompt, width, height, steps, scale, s
     if director_params:
         payload['parameters'].update(director_params) # Example: Merging into 'parameters'
 
-    # Log the request payload for debugging (Remove API key if logging publicly)
-    log_payload = json.loads(json.dumps(payload)) # Deep copy for logging
-    # Consider removing sensitive data for logs: log_payload.pop('input', None) ?
-    info_text = f"NovelAI Request Payload (Check Console for Full Details)" # Placeholder
-    print("--- Sending Payload to NovelAI ---")
-    print(json.dumps(log_payload, indent=2))
-    print("---------------------------------")
+    return payload
+
+
+# Improbable seed literal used as a serialized-template placeholder.
+_SEED_SENTINEL = 184467440737095516
+
+
+def _build_payload_bodies(prompt, neg_prompt, width, height, steps, scale, sampler,
+                          seeds, director_params):
+    """
+    Builds the serialized request body for every seed. The payload dict is
+    constructed and serialized exactly once with a sentinel seed; per-seed
+    bodies are then a plain bytes replace, skipping len(seeds)-1 dict builds
+    and JSON serializations across a batch.
+    Returns: list[bytes]
+    """
+    template = _dumps(_build_payload(prompt, neg_prompt, width, height, steps, scale,
+                                     sampler, _SEED_SENTINEL, director_params))
+    token = str(_SEED_SENTINEL).encode()
+    return [template.replace(token, str(int(s)).encode()) for s in seeds]
+
+
+# --- Response Helpers ---
+_PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
 
+def _open_image(fp, head):
+    """
+    Opens an image, pinning the PNG decoder when the leading bytes match the
+    PNG magic so PIL skips its format-autodetect walk over every registered
+    plugin. Falls back to full autodetect for anything else.
+    """
+    if head[:len(_PNG_MAGIC)] == _PNG_MAGIC:
+        return Image.open(fp, formats=['PNG'])
+    return Image.open(fp)
 
+
+def _splice_png_chunks(png_bytes, chunks):
+    """
+    Splices metadata chunks (e.g. the WebUI's parameters tEXt) into a PNG
+    immediately before IEND, recomputing only the new chunks' CRCs - the
+    encoded image data is untouched.
+    """
+    iend = png_bytes.rfind(b'IEND')
+    if iend < 4:
+        return png_bytes
+    pos = iend - 4 # Start of the IEND chunk's length field
+    out = [png_bytes[:pos]]
+    for chunk in chunks:
+        cid, data = chunk[0], chunk[1]
+        out.append(struct.pack('>I', len(data)))
+        out.append(cid)
+        out.append(data)
+        out.append(struct.pack('>I', zlib.crc32(data, zlib.crc32(cid)) & 0xffffffff))
+    out.append(png_bytes[pos:])
+    return b''.join(out)
+
+
+def _attach_png_passthrough(image, png_bytes):
+    """
+    Shims image.save() on this instance so a PNG save writes the original
+    NAI bytes verbatim instead of re-running libpng's deflate encode
+    (hundreds of ms for a 1024x1024 image). This also preserves NAI's own
+    metadata chunks, which a re-encode would strip; any pnginfo the caller
+    passes (the WebUI's infotext) is spliced in before IEND. Non-PNG
+    targets and copies of the image fall back to the normal encoder.
+    """
+    image.info['nai_png_bytes'] = png_bytes
+    original_save = image.save
+
+    def save(fp, format=None, **params):
+        fmt = (format or '').upper()
+        if not fmt and isinstance(fp, (str, os.PathLike)):
+            fmt = 'PNG' if str(fp).lower().endswith('.png') else ''
+        if fmt == 'PNG':
+            data = png_bytes
+            info_chunks = getattr(params.get('pnginfo'), 'chunks', None)
+            if info_chunks:
+                data = _splice_png_chunks(data, info_chunks)
+            if hasattr(fp, 'write'):
+                fp.write(data)
+            else:
+                with open(fp, 'wb') as f:
+                    f.write(data)
+            return
+        return original_save(fp, format=format, **params)
+
+    image.save = save
+    return image
+
+
+def _image_success_info(seed):
+    """Info string shown in the UI next to a successfully decoded image."""
+    # Try to extract NAI cost/seed from headers if available
+    # final_info = f"NovelAI Info:\nSeed: {response.headers.get('actual-seed', seed)}\nCost: {response.headers.get('anlas-cost', 'N/A')}"
+    return f"Successfully generated image via NovelAI.\nSeed: {seed} (API might use/return a different one)\n(Check console logs for request details)"
+
+
+def _decode_event_stream_response(response, seed):
+    """
+    Incrementally decodes the first base64 image event from a streaming
+    response. Only the decoded bytes are accumulated (never the full base64
+    text), and decoding starts before the TCP stream closes, so peak memory
+    stays at ~one copy of the image and first-byte-to-image latency drops.
+    Returns: Tuple (list[PIL.Image] | None, str) -> (images, info_text/error_message)
+    """
+    # Pre-size the buffer from Content-Length (decoded size is ~3/4 of the
+    # base64 text) so writes land in place instead of repeatedly regrowing.
+    content_length = response.headers.get('content-length', '')
+    if content_length.isdigit():
+        buf = io.BytesIO(bytes((int(content_length) * 3) // 4))
+        buf.seek(0)
+    else:
+        buf = io.BytesIO()
+    head = b''   # First bytes, for the PNG magic check
+    tail = b''   # Rolling last bytes, for the IEND check
+    b64_carry = ''
+    saw_data = False
+    try:
+        try:
+            # Inline stateful SSE parse (same event model as _iter_sse, kept
+            # incremental here so the base64 text is never accumulated).
+            for line in response.iter_lines(decode_unicode=True, chunk_size=65536):
+                if line == '':
+                    # Blank line ends the current event; stop after the first
+                    # event that carried data, flushing any partial quadruplet.
+                    if saw_data:
+                        if b64_carry:
+                            buf.write(_b64decode(b64_carry + '=' * (-len(b64_carry) % 4)))
+                            b64_carry = ''
+                        break
+                    continue
+                if not line.startswith('data:'):
+                    continue
+                saw_data = True
+                b64_carry += line[len('data:'):].lstrip()
+                # Decode only whole base64 quadruplets; keep the remainder
+                # for the next data line.
+                usable = len(b64_carry) - (len(b64_carry) % 4)
+                if usable:
+                    chunk = _b64decode(b64_carry[:usable])
+                    b64_carry = b64_carry[usable:]
+                    if len(head) < len(_PNG_MAGIC):
+                        head = (head + chunk)[:len(_PNG_MAGIC)]
+                    tail = (tail + chunk)[-12:]
+                    buf.write(chunk)
+                # Stop as soon as a complete PNG (magic + IEND chunk) has arrived.
+                if head == _PNG_MAGIC and b'IEND' in tail:
+                    break
+            else:
+                # Stream ended without an early break: flush any partial
+                # final quadruplet (an early break leaves only padding noise).
+                if b64_carry:
+                    buf.write(_b64decode(b64_carry + '=' * (-len(b64_carry) % 4)))
+        except Exception as decode_err:
+            print(f"Error decoding base64 data: {decode_err}")
+            return None, f"Error decoding image data from NovelAI: {decode_err}"
+    finally:
+        response.close()
+
+    size = buf.tell()
+    if not saw_data or not size:
+        print("Could not find base64 data in event-stream response.")
+        return None, "Error: Could not parse image data from NovelAI stream."
+
+    try:
+        # Hand the buffer to PIL directly (no bytes() copy); drop any unused
+        # preallocated tail first.
+        buf.truncate(size)
+        buf.seek(0)
+        image = _open_image(buf, head)
+        image.load() # Materialize now; the buffer is ours but PIL is lazy
+        if head == _PNG_MAGIC:
+            _attach_png_passthrough(image, buf.getvalue())
+        print("Image received and decoded from event stream.")
+        return [image], _image_success_info(seed)
+    except Exception as decode_err:
+        print(f"Error decoding image data: {decode_err}")
+        return None, f"Error decoding image data from NovelAI: {decode_err}"
+
+
+def _read_chunked_binary(response, seed):
+    """
+    Reads a chunked binary body (e.g. image/png or application/octet-stream
+    that does not advertise one of the known content types) and decodes it
+    as an image.
+    Returns: Tuple (list[PIL.Image] | None, str) -> (images, info_text/error_message)
+    """
     try:
-        response = requests.post(NAI_API_ENDPOINT, headers=headers, json=payload, timeout=180) # Long timeout for generation
+        # Let PIL consume the urllib3 file-like directly instead of
+        # rebuffering the body into a second BytesIO copy.
+        response.raw.decode_content = True
+        image = Image.open(response.raw)
+        image.load() # Materialize before the connection is released
+        print("Image received and decoded from chunked binary response.")
+        return [image], _image_success_info(seed)
+    except Exception as decode_err:
+        print(f"Error decoding chunked binary response: {decode_err}")
+        return None, f"Error decoding image data from NovelAI: {decode_err}"
+
+
+def _iter_sse(lines):
+    """
+    Stateful incremental SSE parser. Consumes an iterable of decoded lines
+    and yields one dict per complete event: {'data': [line, ...]} plus an
+    'event' key when the stream names its events. data: continuation lines
+    are accumulated and the in-progress event resets on the blank separator
+    line, so parse cost is O(bytes) no matter how the body is chunked.
+    """
+    event = {'data': []}
+    for raw in lines:
+        if raw == '':
+            if event['data'] or 'event' in event:
+                yield event
+            event = {'data': []}
+        elif raw.startswith('data:'):
+            event['data'].append(raw[len('data:'):].lstrip())
+        elif raw.startswith('event:'):
+            event['event'] = raw[len('event:'):].strip()
+    # Stream ended without a trailing blank line: flush the last event.
+    if event['data'] or 'event' in event:
+        yield event
+
+
+def _decode_event_stream_text(text, seed):
+    """
+    Extracts and decodes the first base64 data event from a fully-read
+    event-stream body (the streaming path uses _decode_event_stream_response).
+    Returns: Tuple (list[PIL.Image] | None, str) -> (images, info_text/error_message)
+    """
+    b64_data = None
+    for event in _iter_sse(text.splitlines()):
+        if event['data']:
+            b64_data = ''.join(event['data'])
+            break # Assume the first data-carrying event has the image
+    if not b64_data:
+        print(f"Could not find base64 data in event-stream response:\n{text}")
+        return None, "Error: Could not parse image data from NovelAI stream."
+
+    try:
+        img_data = _b64decode(b64_data)
+        image = _open_image(io.BytesIO(img_data), img_data[:len(_PNG_MAGIC)])
+        if img_data[:len(_PNG_MAGIC)] == _PNG_MAGIC:
+            _attach_png_passthrough(image, img_data)
+        print("Image received and decoded from event stream.")
+        return [image], _image_success_info(seed) # Return list of images and info string
+    except Exception as decode_err:
+        print(f"Error decoding base64 data: {decode_err}")
+        return None, f"Error decoding image data from NovelAI: {decode_err}"
+
+
+def _decode_zip_body(body, seed):
+    """
+    Extracts every PNG from a zip response body. The zip path is the
+    preferred one: it skips the base64 round-trip entirely (~25% less bytes
+    on the wire, and decoding becomes a plain PNG parse).
+    Returns: Tuple (list[PIL.Image] | None, str) -> (images, info_text/error_message)
+    """
+    try:
+        images = []
+        with zipfile.ZipFile(io.BytesIO(body)) as z:
+            for name in z.namelist():
+                if name.lower().endswith('.png'):
+                    # The member extension already pins the format; a non-PNG
+                    # body raises UnidentifiedImageError into the handler below.
+                    data = z.read(name)
+                    image = Image.open(io.BytesIO(data), formats=['PNG'])
+                    image.load() # Materialize before the archive handle closes
+                    _attach_png_passthrough(image, data)
+                    images.append(image)
+        if not images:
+            return None, "Error: Zip response from NovelAI contained no PNG images."
+        print(f"{len(images)} image(s) extracted from zip response.")
+        return images, _image_success_info(seed)
+    except zipfile.BadZipFile as e:
+        print(f"Error reading zip response: {e}")
+        return None, f"Error: Invalid zip data from NovelAI: {e}"
+    except Exception as decode_err:
+        print(f"Error decoding zip response: {decode_err}")
+        return None, f"Error decoding image data from NovelAI: {decode_err}"
+
+
+def _decode_response_body(content_type, body, seed):
+    """
+    Dispatches a fully-read response body on its content type.
+    Returns: Tuple (list[PIL.Image] | None, str) -> (images, info_text/error_message)
+    """
+    if 'application/zip' in content_type:
+        return _decode_zip_body(body, seed)
+
+    text = body.decode('utf-8', errors='replace')
+    if 'text/event-stream' in content_type or text.strip().startswith('event:'):
+        return _decode_event_stream_text(text, seed)
+    elif 'application/json' in content_type:
+        # Handle JSON response (assuming base64 data inside)
+        # GUESS structure: json_response['images'][0] ? json_response['output']?
+        return None, "Error: JSON response handling not implemented yet (unknown structure)."
+    else:
+        # Fallback/Unknown content type
+        return None, f"Error: Unexpected Content-Type from NovelAI: {content_type}."
+
+
+# --- Async API Calls (aiohttp) ---
+async def _call_nai_async(session, body, headers):
+    """POSTs one pre-serialized payload over an open aiohttp session and reads the body."""
+    async with session.post(NAI_API_ENDPOINT, data=body, headers=headers,
+                            timeout=aiohttp.ClientTimeout(total=180)) as response:
+        print(f"NovelAI Response Status Code: {response.status}")
+        if response.status >= 400:
+            # Read the body before raising so the NAI error message survives
+            # into the ClientResponseError (raise_for_status alone only keeps
+            # the reason phrase).
+            error_body = await response.text()
+            try:
+                message = json.loads(error_body).get('message', error_body)
+            except (ValueError, AttributeError):
+                message = error_body[:200]
+            raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                              status=response.status, message=message,
+                                              headers=response.headers)
+        return response.headers.get('content-type', ''), await response.read()
+
+
+async def _gather_generations(bodies, headers):
+    """Fires all request bodies concurrently over a single pooled HTTPS session."""
+    connector = aiohttp.TCPConnector(limit=8, ssl=True)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        return await asyncio.gather(*[_call_nai_async(session, body, headers)
+                                      for body in bodies])
+
+
+def _run_aiohttp_batch(bodies, headers):
+    """
+    Runs the batch on aiohttp.
+    Returns: Tuple (list | None, str | None) -> (results, error_message)
+    """
+    try:
+        return asyncio.run(_gather_generations(bodies, headers)), None
+    except asyncio.TimeoutError:
+        print("NovelAI request timed out.")
+        return None, "Error: Request to NovelAI timed out."
+    except aiohttp.ClientResponseError as e:
+        # Handle HTTP errors (like 401 Unauthorized, 400 Bad Request, 500 Server Error)
+        print(f"NovelAI API HTTP Error: {e.status} {e.message}")
+        return None, f"NovelAI API Error: HTTP Error: {e.status}\nNovelAI Message: {e.message}"
+    except aiohttp.ClientError as e:
+        print(f"Network error calling NovelAI API: {e}")
+        return None, f"Error: Network error connecting to NovelAI API: {e}"
+    except Exception as e:
+        # Catch-all for unexpected errors during processing
+        print(f"!!! Unexpected Error in _run_aiohttp_batch: {e!r} !!!")
+        if shared.opts.data.get('nai_debug', False):
+            print(traceback.format_exc())
+        return None, f"Unexpected Error: {e}"
+
+
+# --- Async API Calls (httpx / HTTP/2) ---
+async def _call_nai_httpx(client, body, headers):
+    """POSTs one pre-serialized payload over a shared httpx client and reads the body."""
+    response = await client.post(NAI_API_ENDPOINT, content=body, headers=headers)
+    print(f"NovelAI Response Status Code: {response.status_code}")
+    response.raise_for_status()
+    return response.headers.get('content-type', ''), response.content
+
+
+async def _gather_generations_httpx(bodies, headers):
+    """Fires all request bodies concurrently, multiplexed over one httpx client."""
+    async with httpx.AsyncClient(
+            http2=_HTTPX_HTTP2,
+            limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+            timeout=httpx.Timeout(180.0, connect=10.0)) as client:
+        return await asyncio.gather(*[_call_nai_httpx(client, body, headers)
+                                      for body in bodies])
+
+
+def _run_httpx_batch(bodies, headers):
+    """
+    Runs the batch on httpx (HTTP/2 when the h2 extra is installed).
+    Returns: Tuple (list | None, str | None) -> (results, error_message)
+    """
+    try:
+        return asyncio.run(_gather_generations_httpx(bodies, headers)), None
+    except httpx.HTTPStatusError as e:
+        try:
+            message = e.response.json().get('message', e.response.text[:200])
+        except ValueError:
+            message = e.response.text[:200]
+        print(f"NovelAI API HTTP Error: {e.response.status_code} {message}")
+        return None, f"NovelAI API Error: HTTP Error: {e.response.status_code}\nNovelAI Message: {message}"
+    except httpx.TimeoutException:
+        print("NovelAI request timed out.")
+        return None, "Error: Request to NovelAI timed out."
+    except httpx.HTTPError as e:
+        print(f"Network error calling NovelAI API: {e}")
+        return None, f"Error: Network error connecting to NovelAI API: {e}"
+    except Exception as e:
+        # Catch-all for unexpected errors during processing
+        print(f"!!! Unexpected Error in _run_httpx_batch: {e!r} !!!")
+        if shared.opts.data.get('nai_debug', False):
+            print(traceback.format_exc())
+        return None, f"Unexpected Error: {e}"
+
+
+# --- API Call Helpers ---
+def resolve_batch_seeds(seed, n_images):
+    """
+    Expands the UI seed into one concrete seed per image: sequential from a
+    fixed seed, fresh random ones for -1. Resolving -1 client-side keeps
+    every image reproducible instead of leaving the choice to the server.
+    """
+    if int(seed) == -1:
+        return [random.randint(0, 2**32 - 1) for _ in range(n_images)]
+    return [int(seed) + i for i in range(n_images)]
+
+
+def call_novelai_api_batch(api_key, prompt, neg_prompt, width, height, steps, scale,
+                           sampler, seeds, director_json_str):
+    """
+    Batch variant of call_novelai_api: fires one generation per seed,
+    concurrently over one async client, so a batch costs roughly one
+    round-trip instead of len(seeds) sequential ones. Prefers httpx
+    (HTTP/2 multiplexing), then aiohttp, then sequential blocking calls
+    when neither is available.
+    Returns: Tuple (list[PIL.Image] | None, str) -> (images, info_text/error_message)
+    """
+    if not api_key:
+        return None, "Error: NovelAI API Key is missing."
+
+    _lazy_init()
+
+    director_params, error = _parse_director_json(director_json_str)
+    if error:
+        return None, error
+
+    if httpx is None and aiohttp is None:
+        # Sequential fallback: one blocking request per image.
+        images = []
+        info_text = ""
+        for s in seeds:
+            imgs, info_text = call_novelai_api(api_key, prompt, neg_prompt, width, height,
+                                               steps, scale, sampler, s, director_json_str)
+            if not imgs:
+                return None, info_text
+            images.extend(imgs)
+        return images, info_text
+
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "accept": "application/zip", # Prefer binary output; see _decode_zip_body
+        "Accept-Encoding": _ACCEPT_ENCODING
+    }
+    # One dict build + one serialization for the whole batch; only the seed
+    # token differs between the per-seed bodies.
+    bodies = _build_payload_bodies(prompt, neg_prompt, width, height, steps, scale,
+                                   sampler, seeds, director_params)
+
+    # Serve identical payload+seed requests from the result cache; only the
+    # misses go over the wire.
+    keys = [_cache_key(body) for body in bodies]
+    results = [_cache_get(key) for key in keys]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if pending:
+        to_send = [bodies[i] for i in pending]
+        print(f"--- Sending {len(to_send)} concurrent request(s) to NovelAI "
+              f"({len(bodies) - len(to_send)} cached) ---")
+        if httpx is not None:
+            fetched, error = _run_httpx_batch(to_send, headers)
+        else:
+            fetched, error = _run_aiohttp_batch(to_send, headers)
+        if error:
+            return None, error
+        for i, result in zip(pending, fetched):
+            _cache_put(keys[i], result)
+            results[i] = result
+    else:
+        print("--- All requested images served from the NAI result cache ---")
+
+    images = []
+    info_text = ""
+    for (content_type, body), s in zip(results, seeds):
+        imgs, info_text = _decode_response_body(content_type, body, s)
+        if not imgs:
+            return None, info_text
+        images.extend(imgs)
+    return images, info_text
+
+
+def call_novelai_api(api_key, prompt, neg_prompt, width, height, steps, scale, sampler, seed, director_json_str):
+    """
+    Handles the construction of the request and the call to the NovelAI API.
+    Returns: Tuple (list[PIL.Image] | None, str) -> (images, info_text/error_message)
+    """
+    if not api_key:
+        return None, "Error: NovelAI API Key is missing."
+
+    _lazy_init()
+
+    # accept/Content-Type live on the shared session; only the key varies per call.
+    headers = {"Authorization": f"Bearer {api_key}"}
+
+    # --- Parse Director Tools JSON ---
+    director_params, error = _parse_director_json(director_json_str)
+    if error:
+        return None, error
+
+    # --- Construct API Payload ---
+    payload = _build_payload(prompt, neg_prompt, width, height, steps, scale, sampler, seed, director_params)
+
+    # Log the request payload for debugging, but only when the user opted in
+    # via the nai_debug setting - normal runs skip the pretty-print entirely.
+    # A two-level shallow copy is enough here; we only pop top-level keys.
+    if shared.opts.data.get('nai_debug', False):
+        log_payload = copy.copy(payload)
+        log_payload['parameters'] = {**payload['parameters']}
+        # Consider removing sensitive data for logs: log_payload.pop('input', None) ?
+        print("--- Sending Payload to NovelAI ---")
+        print(_dumps(log_payload, pretty=True).decode())
+        print("---------------------------------")
+
+
+    try:
+        # stream=True so event-stream responses can be consumed incrementally
+        # instead of buffering the whole body into response.text first.
+        # Content-Type is already on the session; _dumps avoids requests'
+        # own (stdlib) serialization of json=.
+        response = _SESSION.post(NAI_API_ENDPOINT, headers=headers, data=_dumps(payload),
+                                 timeout=180, stream=True) # Long timeout for generation
 
         print(f"NovelAI Response Status Code: {response.status_code}")
         # print(f"NovelAI Response Headers: {response.headers}") # For debugging NAI headers (cost, seed etc.)
-        # print(f"NovelAI Response Body (text): {response.text[:500]}...") # Log beginning of response
 
         response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
 
@@ -101,52 +787,24 @@ def call_novelai_api(api_key, prompt, neg_prompt, width, height, steps, scale, s
         # !!! 2. JSON with base64 encoded image(s).
         # !!! 3. Server-Sent Events stream.
         # !!! -> You MUST inspect the actual response to implement this correctly. <-
-
-        # Example: Assuming response is like the event stream with base64 data
         content_type = response.headers.get('content-type', '')
-        if 'application/zip' in content_type:
-            # Handle zip file (needs zipfile module)
-            return None, "Error: Zip response handling not implemented yet."
-            # import zipfile
-            # with zipfile.ZipFile(io.BytesIO(response.content)) as z:
-            #     # find image files, extract, open with PIL...
-        elif 'text/event-stream' in content_type or response.text.strip().startswith('event:'):
-             # Example parsing for event stream like structure (VERY FRAGILE)
-            lines = response.text.strip().split('\n')
-            b64_data = None
-            for line in lines:
-                if line.startswith('data:'):
-                    b64_data = line[len('data:'):].strip()
-                    break # Assume first data line has the image
-            if not b64_data:
-                print(f"Could not find base64 data in event-stream response:\n{response.text}")
-                return None, f"Error: Could not parse image data from NovelAI stream. Status: {response.status_code}"
-
+        if 'text/event-stream' in content_type:
+            return _decode_event_stream_response(response, seed)
+        # A chunked transfer with an unadvertised binary content type is still
+        # a streamed image; don't bounce it to the "Unexpected Content-Type"
+        # error branch (retrying that costs a full Anlas-spending re-generation).
+        transfer_encoding = response.headers.get('transfer-encoding', '').lower()
+        if ('chunked' in transfer_encoding
+                and 'application/json' not in content_type
+                and 'application/zip' not in content_type):
             try:
-                img_data = base64.b64decode(b64_data)
-                image = Image.open(io.BytesIO(img_data))
-                print("Image received and decoded from event stream.")
-                # Try to extract NAI cost/seed from headers if available
-                # final_info = f"NovelAI Info:\nSeed: {response.headers.get('actual-seed', seed)}\nCost: {response.headers.get('anlas-cost', 'N/A')}"
-                final_info = f"Successfully generated image via NovelAI.\nSeed: {seed} (API might use/return a different one)\n(Check console logs for request details)"
-                return [image], final_info # Return list of images and info string
-            except Exception as decode_err:
-                 print(f"Error decoding base64 data: {decode_err}")
-                 return None, f"Error decoding image data from NovelAI: {decode_err}"
-
-        elif 'application/json' in content_type:
-             # Handle JSON response (assuming base64 data inside)
-             try:
-                 json_response = response.json()
-                 # GUESS structure: json_response['images'][0] ? json_response['output']?
-                 # b64_data = json_response['some_key_with_base64']
-                 return None, "Error: JSON response handling not implemented yet (unknown structure)."
-             except json.JSONDecodeError:
-                 return None, f"Error: Failed to decode JSON response. Status: {response.status_code}, Content: {response.text[:200]}"
-
-        else:
-             # Fallback/Unknown content type
-             return None, f"Error: Unexpected Content-Type from NovelAI: {content_type}. Status: {response.status_code}"
+                return _read_chunked_binary(response, seed)
+            finally:
+                response.close()
+        try:
+            return _decode_response_body(content_type, response.content, seed)
+        finally:
+            response.close()
 
 
     except requests.exceptions.Timeout:
@@ -159,17 +817,25 @@ def call_novelai_api(api_key, prompt, neg_prompt, width, height, steps, scale, s
             # Try to get error message from NAI response body
             nai_error = e.response.json() # Assuming error details are in JSON
             error_details += f"\nNovelAI Message: {nai_error.get('message', e.response.text)}"
-        except:
+        except (ValueError, json.JSONDecodeError):
             error_details += f"\nResponse: {e.response.text[:200]}" # Fallback to raw text
         print(f"NovelAI API HTTP Error: {error_details}")
         return None, f"NovelAI API Error: {error_details}"
     except requests.exceptions.RequestException as e:
         print(f"Network error calling NovelAI API: {e}")
         return None, f"Error: Network error connecting to NovelAI API: {e}"
+    except (ConnectionResetError, ssl.SSLError) as e:
+        # Known transient transport failures that escape the requests
+        # wrappers: a cheap repr is plenty, no frame walk needed.
+        print(f"Connection error calling NovelAI API: {e!r}")
+        return None, f"Error: Connection error to NovelAI API: {e!r}"
     except Exception as e:
-        # Catch-all for unexpected errors during processing
-        print(f"!!! Unexpected Error in call_novelai_api !!!")
-        print(traceback.format_exc())
+        # Catch-all for unexpected errors during processing. Formatting the
+        # full traceback walks frames and reads source from disk, so under
+        # retry storms (e.g. rapid 429s) it only runs with nai_debug on.
+        print(f"!!! Unexpected Error in call_novelai_api: {e!r} !!!")
+        if shared.opts.data.get('nai_debug', False):
+            print(traceback.format_exc())
         return None, f"Unexpected Error: {e}"
 
 
@@ -212,6 +878,10 @@ class NovelAIDirectorScript(scripts.Script):
                 info="ADVANCED: Requires knowing the exact JSON structure NAI expects for Director features."
             )
 
+            clear_cache = gr.Button(value="Clear NAI result cache",
+                                    elem_id="nai_clear_result_cache", size="sm")
+            clear_cache.click(fn=clear_result_cache, inputs=[], outputs=[])
+
             # Add info text about costs and API usage
             gr.Markdown("""
             **Warning:** Using this feature sends your prompts and settings to NovelAI's servers via their **unofficial API**.
@@ -233,15 +903,26 @@ class NovelAIDirectorScript(scripts.Script):
         """
 
         if not enabled:
-            # If not enabled, do nothing and let the standard pipeline continue
-            print("NovelAI script: Disabled, skipping.")
-            return processing.Processed(p, [], p.seed, "") # Must return a Processed object
+            # Returning None lets ScriptRunner fall through to the normal
+            # txt2img pipeline; an empty Processed here would short-circuit
+            # local generation entirely.
+            return None
 
         print("NovelAI script: Enabled, attempting to override generation.")
 
+        # First enabled generation pays the deferred import cost here, not at
+        # WebUI boot; it also guarantees _SESSION exists for the interrupt path.
+        _lazy_init()
+
         # Use parameters from the main UI (prompt, negative_prompt, width, height)
         # Use parameters from our script's UI (steps, sampler, scale, seed, api_key, director_json)
-        images, info_text = call_novelai_api(
+        # Batch count/size from the main UI decide how many concurrent generations we fire.
+        n_images = max(1, int(p.n_iter) * int(p.batch_size))
+        seeds = resolve_batch_seeds(seed, n_images)
+        # Submit to the worker pool and poll, so this (WebUI) thread stays
+        # responsive and the Interrupt button actually aborts the wait.
+        future = _POOL.submit(
+            call_novelai_api_batch,
             api_key=api_key,
             prompt=p.prompt,
             neg_prompt=p.negative_prompt,
@@ -250,16 +931,28 @@ class NovelAIDirectorScript(scripts.Script):
             steps=steps,
             scale=scale,
             sampler=sampler,
-            seed=seed,
+            seeds=seeds,
             director_json_str=director_tools_json
         )
+        while not future.done():
+            time.sleep(0.1)
+            if shared.state.interrupted:
+                future.cancel()
+                # Tear down the pooled requests connections so an in-flight
+                # fallback request errors out instead of waiting out the full
+                # 180s timeout. (The aiohttp path owns its session; its
+                # workers finish in the background and their result is
+                # discarded - the Anlas is spent server-side either way.)
+                _SESSION.close()
+                print("NovelAI script: Generation interrupted by user.")
+                return processing.Processed(p, [], p.seed, "NovelAI generation interrupted.")
+        images, info_text = future.result()
 
         if images:
             print(f"NovelAI script: Successfully received {len(images)} image(s).")
             # Create a Processed object to return results to the WebUI
-            # Use the seed requested, as the actual seed might not be easily available/parsed yet
             # The info_text from call_novelai_api will be displayed in the UI
-            proc = processing.Processed(p, images, int(seed), info_text)
+            proc = processing.Processed(p, images, seeds[0], info_text)
 
             # Optional: Try to update the 'infotexts' field with more structured data if needed by other extensions
             # proc.infotexts = [info_text] * len(images)
@@ -272,4 +965,3 @@ class NovelAIDirectorScript(scripts.Script):
             # This prevents the WebUI from potentially crashing and shows the error to the user
             p.extra_generation_params["NovelAI Error"] = info_text # Add to extra params
             return processing.Processed(p, [], p.seed, f"NovelAI Generation Failed: {info_text}")
-